@@ -1,58 +1,122 @@
+import hashlib
+import io
 import streamlit as st
 import logging
 import os
-from coreLogic import custom_parse_formula, Tableaux
-
-logging.basicConfig(level=logging.DEBUG)
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PIL import Image
+import coreLogic
+from coreLogic import (custom_parse_formula, connectives, is_modal, And, Box, Diamond, Implies, Not, Or, Tableaux,
+                       TimeoutError)
+
+logging.basicConfig(level=os.getenv("LOGLEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
+# Each solution keeps its rendered images, so the history is bounded; the oldest solutions are dropped first
+MAX_SOLUTION_HISTORY = 50
 
-def solve_formula(formula_str: str):
-    try:
-        logger.debug(f"Parsing formula: {formula_str}")
-        formula = custom_parse_formula(formula_str)
+# Seconds a single tableau search may run before the solve is reported as timed out
+SOLVE_TIMEOUT = 10
+
+# Digest of the solver and of this app, part of every disk-cached key: verdicts and images stored by older code are
+# not served again once either of them changes
+with open(coreLogic.__file__, 'rb') as core_source, open(__file__, 'rb') as app_source:
+    CACHE_VERSION = hashlib.sha256(core_source.read() + app_source.read()).hexdigest()[:16]
+
+# Rendering mostly waits on the Graphviz subprocess, so the images of both tableaux are drawn side by side
+_render_pool = ThreadPoolExecutor(max_workers=2)
+
+
+# Parsed formulas are immutable, so each input string only has to be parsed once per process
+@lru_cache(maxsize=1024)
+def parse_formula(formula_str: str):
+    return custom_parse_formula(formula_str)
+
+
+# Re-encode a rendered PNG as lossless WebP, which is smaller to keep in the cache and to send on every rerun
+def to_webp(image: bytes) -> bytes:
+    buffer = io.BytesIO()
+    Image.open(io.BytesIO(image)).save(buffer, 'webp', lossless=True, method=4)
+    return buffer.getvalue()
 
-        logger.debug("Creating Tableaux instance for validity check")
-        validity_solver = Tableaux(formula)
-        is_valid = validity_solver.check_validity()
-        logger.debug(f"Validity result: {is_valid}")
 
-        logger.debug("Saving validity graph to file")
-        validity_image_path = validity_solver.save_graph_to_file()
-        logger.debug(f"Validity image saved to: {validity_image_path}")
+# Each solver's images are rendered in one task, as drawing may still have to expand its deferred tableau. The tableau
+# is kept as SVG, which stays sharp however large the tree grows. A propositional formula has no accessibility graph
+# beyond its single root world, so none is drawn
+def render_images(solver: Tableaux, modal: bool):
+    accessibility_image = to_webp(solver.accessibility_graph_png()) if modal else None
+    return solver.graph_svg(), accessibility_image
 
-        logger.debug("Saving validity accessibility graph")
-        validity_accessibility_image_path = validity_solver.save_accessibility_graph()
-        logger.debug(f"Validity accessibility image saved to: {validity_accessibility_image_path}")
 
-        logger.debug("Creating Tableaux instance for satisfiability check")
-        satisfiability_solver = Tableaux(formula)
-        is_satisfiable = satisfiability_solver.check_satisfiability()
-        logger.debug(f"Satisfiability result: {is_satisfiable}")
+def check_formula(formula_str: str):
+    logger.debug("Parsing formula: %s", formula_str)
+    formula = parse_formula(formula_str)
 
-        logger.debug("Saving satisfiability graph to file")
-        satisfiability_image_path = satisfiability_solver.save_graph_to_file()
-        logger.debug(f"Satisfiability image saved to: {satisfiability_image_path}")
+    logger.debug("Checking validity and satisfiability")
+    is_valid, is_satisfiable, _, _ = Tableaux.check_both(formula, timeout=SOLVE_TIMEOUT)
+    logger.debug("Validity result: %s, satisfiability result: %s", is_valid, is_satisfiable)
 
-        logger.debug("Saving satisfiability accessibility graph")
-        satisfiability_accessibility_image_path = satisfiability_solver.save_accessibility_graph()
-        logger.debug(f"Satisfiability accessibility image saved to: {satisfiability_accessibility_image_path}")
+    return is_valid, is_satisfiable, Tableaux.formula_to_string(formula)
 
-        return (is_valid, is_satisfiable, Tableaux.formula_to_string(formula),
-                validity_image_path, satisfiability_image_path,
-                validity_accessibility_image_path, satisfiability_accessibility_image_path)
+
+# Errors are raised by check and only turned into a (None, None, message) result here, outside the caches, so a parse
+# error or a timed out solve is never stored as if it were the formula's verdict
+def solve_formula(formula_str: str, check=check_formula):
+    try:
+        return check(formula_str)
 
     except ValueError as ve:
-        logger.error(f"ValueError in solve_formula: {str(ve)}", exc_info=True)
-        return None, None, "INVALID", None, None, None, None
+        logger.error("ValueError in solve_formula: %s", ve, exc_info=True)
+        return None, None, "INVALID"
     except TimeoutError as te:
-        logger.error(f"TimeoutError in solve_formula: {str(te)}", exc_info=True)
-        return None, None, f"Computation timed out: {str(te)}", None, None, None, None
+        logger.error("TimeoutError in solve_formula: %s", te, exc_info=True)
+        return None, None, f"Computation timed out: {str(te)}"
     except Exception as e:
-        logger.error(f"Unexpected error in solve_formula: {str(e)}", exc_info=True)
-        return None, None, f"An unexpected error occurred: {str(e)}", None, None, None, None
+        logger.error("Unexpected error in solve_formula: %s", e, exc_info=True)
+        return None, None, f"An unexpected error occurred: {str(e)}"
+
+
+# Rendering the four images of a solved formula. Validity and satisfiability are known again straight from the shared
+# root verdicts, and both tableaux are drawn side by side
+def render_solution_images(formula_str: str):
+    formula = parse_formula(formula_str)
+    _, _, validity_solver, satisfiability_solver = Tableaux.check_both(formula, timeout=SOLVE_TIMEOUT)
+
+    logger.debug("Rendering validity and satisfiability graphs")
+    modal = is_modal(formula)
+    validity_images = _render_pool.submit(render_images, validity_solver, modal)
+    satisfiability_images = _render_pool.submit(render_images, satisfiability_solver, modal)
+    validity_image, validity_accessibility_image = validity_images.result()
+    satisfiability_image, satisfiability_accessibility_image = satisfiability_images.result()
+    return validity_image, satisfiability_image, validity_accessibility_image, satisfiability_accessibility_image
+
+
+# Solving and rendering are deterministic in the parsed formula, so both are cached across reruns, sessions and
+# restarts, keyed on the canonical string so inputs differing only in spacing or notation share an entry, and on
+# CACHE_VERSION. The images are the bulk of each entry, so fewer of them are kept
+@st.cache_data(max_entries=1024, show_spinner=False, persist="disk")
+def solve_canonical_formula(canonical_str: str, cache_version: str):
+    return check_formula(canonical_str)
+
 
+@st.cache_data(max_entries=256, show_spinner=False, persist="disk")
+def cached_render_solution_images(canonical_str: str, cache_version: str):
+    return render_solution_images(canonical_str)
 
+
+def check_canonical_formula(formula_str: str):
+    return solve_canonical_formula(Tableaux.formula_to_string(parse_formula(formula_str)), CACHE_VERSION)
+
+
+def cached_solve_formula(formula_str: str):
+    return solve_formula(formula_str, check_canonical_formula)
+
+
+# The analysis texts are pure functions of their arguments and are rebuilt on every rerun that shows a solution
+@lru_cache(maxsize=512)
 def analyze_result(is_valid, is_satisfiable, formula_str):
     propositional_analysis = analyze_propositional(is_valid, is_satisfiable, formula_str)
     modal_analysis = analyze_modal(is_valid, is_satisfiable, formula_str)
@@ -66,47 +130,49 @@ def analyze_result(is_valid, is_satisfiable, formula_str):
     """
 
 
-def analyze_propositional(is_valid, is_satisfiable, formula_str):
-    if is_valid and is_satisfiable:
-        return f"""
-        In propositional logic, the formula '{formula_str}' is a tautology:
+# Analysis texts per (is_valid, is_satisfiable) verdict; the formula is filled in with %
+_PROPOSITIONAL_ANALYSIS = {
+    (True, True): """
+        In propositional logic, the formula '%s' is a tautology:
         - It is true under all possible truth assignments to its atomic propositions.
         - Its truth table would show 'True' for all rows.
         - It can be derived from axioms using rules of inference.
         - Its negation is unsatisfiable (a contradiction).
-        """
-    elif not is_valid and is_satisfiable:
-        return f"""
-        In propositional logic, the formula '{formula_str}' is contingent:
+        """,
+    (False, True): """
+        In propositional logic, the formula '%s' is contingent:
         - Its truth value depends on the truth assignments of its atomic propositions.
         - Its truth table would show both 'True' and 'False' entries.
         - It's neither a tautology nor a contradiction.
         - Both this formula and its negation are satisfiable.
-        """
-    elif not is_valid and not is_satisfiable:
-        return f"""
-        In propositional logic, the formula '{formula_str}' is a contradiction:
+        """,
+    (False, False): """
+        In propositional logic, the formula '%s' is a contradiction:
         - It is false under all possible truth assignments to its atomic propositions.
         - Its truth table would show 'False' for all rows.
         - It's logically equivalent to 'p ∧ ¬p' for any proposition p.
         - Its negation is a tautology.
-        """
-    else:
+        """,
+}
+
+
+def analyze_propositional(is_valid, is_satisfiable, formula_str):
+    template = _PROPOSITIONAL_ANALYSIS.get((is_valid, is_satisfiable))
+    if template is None:
         return "Error: Invalid result combination in propositional logic."
+    return template % formula_str
 
 
-def analyze_modal(is_valid, is_satisfiable, formula_str):
-    if is_valid and is_satisfiable:
-        return f"""
-        In modal logic, the formula '{formula_str}' is valid (necessarily true):
+_MODAL_ANALYSIS = {
+    (True, True): """
+        In modal logic, the formula '%s' is valid (necessarily true):
         - It is true in all possible worlds of all Kripke models.
         - It represents a necessary truth in the modal system.
         - It's analogous to a tautology in propositional logic, but across possible worlds.
         - Examples include axioms of the modal system (e.g., □(p → q) → (□p → □q) in K).
-        """
-    elif not is_valid and is_satisfiable:
-        return f"""
-        In modal logic, the formula '{formula_str}' is satisfiable but not valid:
+        """,
+    (False, True): """
+        In modal logic, the formula '%s' is satisfiable but not valid:
         - There exists at least one Kripke model with a world where the formula is true.
         - However, it's not true in all worlds of all models.
         - It represents a contingent statement in modal logic.
@@ -115,25 +181,29 @@ def analyze_modal(is_valid, is_satisfiable, formula_str):
           1. Possibly true but not necessary (true in some but not all worlds).
           2. True in the actual world but not in all possible worlds.
         - The specific modal operators (□, ◇) in the formula affect its interpretation across worlds.
-        """
-    elif not is_valid and not is_satisfiable:
-        return f"""
-        In modal logic, the formula '{formula_str}' is unsatisfiable (necessarily false):
+        """,
+    (False, False): """
+        In modal logic, the formula '%s' is unsatisfiable (necessarily false):
         - It is false in all possible worlds of all Kripke models.
         - It represents an impossible statement in the modal system.
         - It's analogous to a contradiction in propositional logic, but across possible worlds.
         - Its negation is valid (necessarily true) in the modal system.
         - Examples include formulas like '□p ∧ ◇¬p' (necessarily p and possibly not p).
-        """
-    else:
+        """,
+}
+
+
+def analyze_modal(is_valid, is_satisfiable, formula_str):
+    template = _MODAL_ANALYSIS.get((is_valid, is_satisfiable))
+    if template is None:
         return "Error: Invalid result combination in modal logic."
+    return template % formula_str
 
 
-def process_chat_input(prompt):
-    if "solve" in prompt.lower():
-        return "To solve a formula, enter it in the main text area and click the 'Solve' button."
-    elif "syntax" in prompt.lower():
-        return """
+# Canned chat replies, checked in order against the keywords found in the prompt
+_CHAT_RESPONSES = {
+    "solve": "To solve a formula, enter it in the main text area and click the 'Solve' button.",
+    "syntax": """
         Syntax:
         - Atoms: lowercase letters (e.g., p, q, r)
         - Negation: ~ (e.g., ~p)
@@ -142,67 +212,93 @@ def process_chat_input(prompt):
         - Implication: -> (e.g., p -> q)
         - Box (Necessity): [] (e.g., []p)
         - Diamond (Possibility): <> (e.g., <>p)
-        """
-    else:
-        return (f"I'm an AI assistant for the Semantic Tableaux Solver. You asked: '{prompt}'. How can I help you with "
-                f"modal logic formulas?")
+        """,
+}
+# Every keyword of the prompt, found in a single case-insensitive scan
+_CHAT_PATTERN = re.compile('|'.join(map(re.escape, _CHAT_RESPONSES)), re.IGNORECASE)
+
+
+def process_chat_input(prompt):
+    keywords = {keyword.lower() for keyword in _CHAT_PATTERN.findall(prompt)}
+    for keyword, response in _CHAT_RESPONSES.items():
+        if keyword in keywords:
+            return response
+    return (f"I'm an AI assistant for the Semantic Tableaux Solver. You asked: '{prompt}'. How can I help you with "
+            f"modal logic formulas?")
 
 
+# The operators are read from the parsed formula, which is already cached, rather than by scanning its string again
+@lru_cache(maxsize=512)
 def analyze_formula_structure(formula_str):
-    modal_operators = ['□', '◇', '[]', '<>']
-    has_modal = any(op in formula_str for op in modal_operators)
+    operators = connectives(parse_formula(formula_str))
+    has_necessity = Box in operators
+    has_possibility = Diamond in operators
+    has_modal = has_necessity or has_possibility
 
     analysis = f"The formula '{formula_str}' is a "
     if has_modal:
         analysis += "modal logic formula. "
-        if '□' in formula_str or '[]' in formula_str:
+        if has_necessity:
             analysis += "It contains the necessity operator (□ or []), which means 'it is necessary that' or 'in all accessible worlds'. "
-        if '◇' in formula_str or '<>' in formula_str:
+        if has_possibility:
             analysis += "It contains the possibility operator (◇ or <>), which means 'it is possible that' or 'in at least one accessible world'. "
     else:
         analysis += "propositional logic formula. "
 
-    if '->' in formula_str:
+    if Implies in operators:
         analysis += "It involves implication, which might be analyzing conditional statements. "
-    if '&' in formula_str:
+    if And in operators:
         analysis += "It uses conjunction, combining multiple conditions. "
-    if '|' in formula_str:
+    if Or in operators:
         analysis += "It includes disjunction, representing alternative conditions. "
-    if '~' in formula_str:
+    if Not in operators:
         analysis += "It employs negation, which might be crucial for its logical properties. "
 
     return analysis
 
 
-def display_solution(solution):
-    formula_str, is_valid, is_satisfiable, parsed_formula, validity_image_path, satisfiability_image_path, \
-        validity_accessibility_image_path, satisfiability_accessibility_image_path = solution
+# Images of a stored solution, rendered the first time it is displayed and then kept with it. By then the verdicts are
+# already on the page, so slow renders no longer hold back the rest of the result
+def solution_images(index):
+    solution = st.session_state.solutions[index]
+    if solution[4] is None:
+        try:
+            images = cached_render_solution_images(solution[3], CACHE_VERSION)
+        except TimeoutError as te:
+            # Not cached, so the images are drawn again the next time the solution is displayed
+            logger.error("TimeoutError rendering solution images: %s", te, exc_info=True)
+            st.error(f"Drawing the tableaux timed out: {str(te)}")
+            return None, None, None, None
+        except Exception as e:
+            logger.error("Error rendering solution images: %s", e, exc_info=True)
+            st.error(f"An unexpected error occurred while drawing the tableaux: {str(e)}")
+            return None, None, None, None
+        solution = solution[:4] + images
+        st.session_state.solutions[index] = solution
+    return solution[4:]
+
+
+def display_solution(index):
+    formula_str, is_valid, is_satisfiable, parsed_formula = st.session_state.solutions[index][:4]
 
     st.write(f"Parsed formula: {parsed_formula}")
 
     st.subheader("Validity Check")
     if is_valid:
-        st.success(f"The formula is valid.")
+        st.success("The formula is valid.")
     else:
-        st.error(f"The formula is not valid.")
+        st.error("The formula is not valid.")
 
-    if validity_image_path:
-        st.image(validity_image_path, caption='Validity Tableau Visualization')
-
-    if validity_accessibility_image_path:
-        st.image(validity_accessibility_image_path, caption='Validity Accessibility Graph')
+    # The images go in their place below each verdict, but are only drawn once all the text is on the page
+    validity_images = st.container()
 
     st.subheader("Satisfiability Check")
     if is_satisfiable:
-        st.success(f"The formula is satisfiable.")
+        st.success("The formula is satisfiable.")
     else:
-        st.error(f"The formula is not satisfiable (contradiction).")
-
-    if satisfiability_image_path:
-        st.image(satisfiability_image_path, caption='Satisfiability Tableau Visualization')
+        st.error("The formula is not satisfiable (contradiction).")
 
-    if satisfiability_accessibility_image_path:
-        st.image(satisfiability_accessibility_image_path, caption='Satisfiability Accessibility Graph')
+    satisfiability_images = st.container()
 
     st.subheader("Conclusion")
     if is_valid and is_satisfiable:
@@ -220,6 +316,23 @@ def display_solution(solution):
     structure_analysis = analyze_formula_structure(parsed_formula)
     st.write(structure_analysis)
 
+    with validity_images:
+        validity_image, satisfiability_image, validity_accessibility_image, satisfiability_accessibility_image = \
+            solution_images(index)
+
+        if validity_image:
+            st.image(validity_image, caption='Validity Tableau Visualization')
+
+        if validity_accessibility_image:
+            st.image(validity_accessibility_image, caption='Validity Accessibility Graph')
+
+    with satisfiability_images:
+        if satisfiability_image:
+            st.image(satisfiability_image, caption='Satisfiability Tableau Visualization')
+
+        if satisfiability_accessibility_image:
+            st.image(satisfiability_accessibility_image, caption='Satisfiability Accessibility Graph')
+
 
 def select_solution(index):
     st.session_state.selected_index = index
@@ -227,11 +340,40 @@ def select_solution(index):
     st.session_state.editing = True
 
 
+# Solve button callback. Callbacks run before the script, so the new solution already shows up in the sidebar and
+# the solution panel on the same run instead of after a second full st.rerun() pass
+def solve_current_formula():
+    formula_str = st.session_state.formula_input
+    logger.debug("Solve button clicked with formula: %s", formula_str)
+    is_valid, is_satisfiable, parsed_formula = cached_solve_formula(formula_str)
+
+    if is_valid is not None and is_satisfiable is not None:
+        # The images are rendered when the solution is first displayed
+        solution = (formula_str, is_valid, is_satisfiable, parsed_formula, None, None, None, None)
+
+        if st.session_state.editing and st.session_state.selected_index is not None:
+            # Update existing solution
+            st.session_state.solutions[st.session_state.selected_index] = solution
+        else:
+            # Add new solution
+            st.session_state.solutions.append(solution)
+            st.session_state.selected_index = len(st.session_state.solutions) - 1
+
+        st.session_state.current_formula = formula_str
+        st.session_state.editing = False
+    else:
+        if parsed_formula == "INVALID":
+            st.session_state.solve_error = "Invalid formula. Please check your input and try again."
+        else:
+            st.session_state.solve_error = parsed_formula  # Display other error messages
+        logger.error("Error solving formula: %s", parsed_formula)
+
+
 def main():
     st.title("Semantic Tableaux Solver")
 
     if "solutions" not in st.session_state:
-        st.session_state.solutions = []
+        st.session_state.solutions = deque(maxlen=MAX_SOLUTION_HISTORY)
 
     if "current_formula" not in st.session_state:
         st.session_state.current_formula = "p & q"
@@ -242,9 +384,12 @@ def main():
     if "editing" not in st.session_state:
         st.session_state.editing = False
 
+    if "solve_error" not in st.session_state:
+        st.session_state.solve_error = None
+
     # Sidebar
     st.sidebar.title("Solution History")
-    solutions_to_remove = []
+    solutions_to_remove = set()
     for i, solution in enumerate(st.session_state.solutions):
         col1, col2 = st.sidebar.columns([5, 1])
         with col1:
@@ -253,20 +398,20 @@ def main():
                 pass
         with col2:
             if st.button("🗑️", key=f"delete_{i}", help="Delete this solution"):
-                solutions_to_remove.append(i)
+                solutions_to_remove.add(i)
 
-    # Remove deleted solutions
+    # Remove deleted solutions, rebuilding the list once instead of deleting entries one by one
     if solutions_to_remove:
-        for index in reversed(solutions_to_remove):
-            if 0 <= index < len(st.session_state.solutions):
-                del st.session_state.solutions[index]
-                if st.session_state.selected_index is not None:
-                    if index < st.session_state.selected_index:
-                        st.session_state.selected_index -= 1
-                    elif index == st.session_state.selected_index:
-                        st.session_state.selected_index = None
-                        st.session_state.current_formula = "p & q"
-                        st.session_state.editing = False
+        selected_index = st.session_state.selected_index
+        st.session_state.solutions = deque((solution for i, solution in enumerate(st.session_state.solutions)
+                                            if i not in solutions_to_remove), maxlen=MAX_SOLUTION_HISTORY)
+        if selected_index is not None:
+            if selected_index in solutions_to_remove:
+                st.session_state.selected_index = None
+                st.session_state.current_formula = "p & q"
+                st.session_state.editing = False
+            else:
+                st.session_state.selected_index -= sum(1 for index in solutions_to_remove if index < selected_index)
         if st.session_state.solutions:
             if st.session_state.selected_index is None or st.session_state.selected_index >= len(
                     st.session_state.solutions):
@@ -302,35 +447,13 @@ def main():
         if not st.session_state.editing:
             st.session_state.selected_index = None
 
-    if st.button("Solve"):
-        logger.debug(f"Solve button clicked with formula: {formula_str}")
-        (is_valid, is_satisfiable, parsed_formula, validity_image_path, satisfiability_image_path,
-         validity_accessibility_image_path, satisfiability_accessibility_image_path) = solve_formula(formula_str)
-
-        if is_valid is not None and is_satisfiable is not None:
-            solution = (formula_str, is_valid, is_satisfiable, parsed_formula, validity_image_path,
-                        satisfiability_image_path, validity_accessibility_image_path,
-                        satisfiability_accessibility_image_path)
-
-            if st.session_state.editing and st.session_state.selected_index is not None:
-                # Update existing solution
-                st.session_state.solutions[st.session_state.selected_index] = solution
-            else:
-                # Add new solution
-                st.session_state.solutions.append(solution)
-                st.session_state.selected_index = len(st.session_state.solutions) - 1
+    st.button("Solve", on_click=solve_current_formula)
+    if st.session_state.solve_error:
+        st.error(st.session_state.solve_error)
+        st.session_state.solve_error = None
 
-            st.session_state.current_formula = formula_str
-            st.session_state.editing = False
-            st.rerun()
-        else:
-            if parsed_formula == "INVALID":
-                st.error("Invalid formula. Please check your input and try again.")
-            else:
-                st.error(parsed_formula)  # Display other error messages
-            logger.error(f"Error solving formula: {parsed_formula}")
     if st.session_state.selected_index is not None:
-        display_solution(st.session_state.solutions[st.session_state.selected_index])
+        display_solution(st.session_state.selected_index)
 
 
 if __name__ == "__main__":
@@ -1,176 +1,606 @@
+import io
+import os
+import re
+import itertools
+import subprocess
 import tempfile
 import threading
-from collections import defaultdict
+import time
+from collections import defaultdict, OrderedDict
 from dataclasses import dataclass
-from typing import List, Tuple, Set, Dict
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Tuple, Set, Dict, FrozenSet, Optional
+from weakref import WeakValueDictionary
 import logging
 
-import networkx as nx
-import pydot
-from matplotlib import pyplot as plt
+# networkx and matplotlib are only needed to draw accessibility graphs. They make up most of the import time of this
+# module, so they are imported by the methods that draw instead of on every import of the solver
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOGLEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
 
+# Raised when a search runs past the time limit of its Tableaux
 class TimeoutError(Exception):
     pass
 
 
-# Multithreading logic. For current solution, this is not required. Normal single threaded code is working fast
-# enough This can be implemented for the increase in complexity and further concepts in Modal Logic followed by more
-# complex Kripke Model diagram generation
-def run_with_timeout(func, args=(), kwargs={}, timeout_duration=10):
-    result = [TimeoutError('function {} timed out after {} seconds'.format(func.__name__, timeout_duration))]
-
-    def worker():
-        try:
-            result[0] = func(*args, **kwargs)
-        except Exception as e:
-            result[0] = e
-
-    thread = threading.Thread(target=worker)
-    thread.start()
-    thread.join(timeout_duration)
-    if thread.is_alive():
-        return TimeoutError('function {} timed out after {} seconds'.format(func.__name__, timeout_duration))
-    if isinstance(result[0], Exception):
-        raise result[0]
-    return result[0]
+# Raised inside a search that may stop early, once a saturated open branch shows that the tableau cannot close
+class _OpenBranchFound(Exception):
+    pass
 
 
-# Data classes for each literal in Propositional Logic and Modal Logic
-@dataclass
+# Data classes for each literal in Propositional Logic and Modal Logic. Nodes are immutable and built through mk()
+# so structurally identical subformulas share one object. Equality and hashing are therefore by identity, which is O(1)
+# instead of a walk over the whole tree
+@dataclass(frozen=True, eq=False)
 class Formula:
-    pass
+    __slots__ = ('__weakref__',)  # No per-node __dict__; the weakref slot keeps nodes usable in the intern table
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Atom(Formula):
     name: str
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Not(Formula):
     formula: Formula
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class And(Formula):
-    conjuncts: List[Formula]
+    conjuncts: Tuple[Formula, ...]
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Or(Formula):
-    disjuncts: List[Formula]
+    disjuncts: Tuple[Formula, ...]
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Implies(Formula):
     left: Formula
     right: Formula
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Box(Formula):
     formula: Formula
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class Diamond(Formula):
     formula: Formula
 
 
-Branch = List[Tuple[bool, str, Formula]]
+# Hash-consing table. Children are interned before their parents, so a node is keyed by the ids of its children. Sequent
+# keys tell entries apart by formula identity, so two threads must never intern separate copies of the same node: a
+# miss is rechecked and filled under a lock
+_INTERN: WeakValueDictionary = WeakValueDictionary()
+_INTERN_LOCK = threading.Lock()
 
 
-# Checking for a closed branch
-def is_closed(branch: Branch, accessibility: Dict[str, Set[str]]) -> bool:
-    world_formulas = defaultdict(lambda: (set(), set()))
-    for sign, world, formula in branch:
-        if isinstance(formula, Atom):
-            if sign:
-                world_formulas[world][0].add(formula.name)
-            else:
-                world_formulas[world][1].add(formula.name)
+def _intern_key(arg):
+    if isinstance(arg, tuple):
+        return tuple(id(sub_formula) for sub_formula in arg)
+    if isinstance(arg, Formula):
+        return id(arg)
+    return arg
+
+
+def mk(cls, *args) -> Formula:
+    key = (cls,) + tuple(_intern_key(arg) for arg in args)
+    formula = _INTERN.get(key)
+    if formula is None:
+        with _INTERN_LOCK:
+            formula = _INTERN.get(key)
+            if formula is None:
+                formula = cls(*args)
+                _INTERN[key] = formula
+    return formula
 
-    for world in world_formulas:
-        pos, neg = world_formulas[world]
-        if pos & neg:
-            return True
 
-    return False
+# Pieces each formula class is written as, dispatched on the exact type instead of an isinstance chain. A piece is
+# either text or a subformula that is written in its place
+def _joined(separator: str, operands) -> list:
+    pieces = []
+    for operand in operands:
+        pieces += [separator, operand]
+    return pieces[1:]
+
+
+_TO_PIECES = {
+    Atom: lambda formula: [formula.name],
+    Not: lambda formula: ["~", formula.formula],
+    And: lambda formula: ["(", *_joined(" & ", formula.conjuncts), ")"],
+    Or: lambda formula: ["(", *_joined(" | ", formula.disjuncts), ")"],
+    Implies: lambda formula: ["(", formula.left, " -> ", formula.right, ")"],
+    Box: lambda formula: ["[]", formula.formula],
+    Diamond: lambda formula: ["<>", formula.formula],
+}
+
+
+def formula_to_string(formula: Formula) -> str:
+    if not isinstance(formula, Formula):
+        raise ValueError(f"Unknown formula type: {type(formula)}")
+    return _formula_string(formula)
+
+
+# Formulas are immutable, so the strings callers ask for are cached; the strings of their subformulas are not kept.
+# The formula is written in one pass from an explicit stack of pieces, so deeply nested formulas do not hit the
+# recursion limit
+@lru_cache(maxsize=4096)
+def _formula_string(formula: Formula) -> str:
+    parts = []
+    stack = [formula]
+    while stack:
+        piece = stack.pop()
+        if isinstance(piece, str):
+            parts.append(piece)
+            continue
+        to_pieces = _TO_PIECES.get(type(piece))
+        if to_pieces is None:
+            raise ValueError(f"Unknown formula type: {type(piece)}")
+        stack.extend(reversed(to_pieces(piece)))
+    return "".join(parts)
+
+
+# Direct subformulas of each formula class
+_CHILDREN = {
+    Atom: lambda formula: (),
+    Not: lambda formula: (formula.formula,),
+    And: lambda formula: formula.conjuncts,
+    Or: lambda formula: formula.disjuncts,
+    Implies: lambda formula: (formula.left, formula.right),
+    Box: lambda formula: (formula.formula,),
+    Diamond: lambda formula: (formula.formula,),
+}
+
+
+# Distinct subformulas of a formula, including itself
+def subformulas(formula: Formula) -> List[Formula]:
+    seen, result, stack = set(), [], [formula]
+    while stack:
+        formula = stack.pop()
+        if id(formula) not in seen:
+            seen.add(id(formula))
+            result.append(formula)
+            stack.extend(_CHILDREN[type(formula)](formula))
+    return result
+
+
+# Propositional formulas with at most this many atoms are decided by a truth table instead of the tableau
+MAX_TRUTH_TABLE_ATOMS = 16
+
+
+# Truth table of a propositional formula as one int: bit w is set iff the formula holds under valuation w, where
+# atom i is true in valuation w iff bit i of w is set
+def truth_table_mask(formula: Formula, atoms: List[str]) -> int:
+    size = 1 << len(atoms)
+    full_mask = (1 << size) - 1
+    masks = {}
+    for i, name in enumerate(atoms):
+        # Repeat a block of 2^i zeros followed by 2^i ones across all valuations
+        block = 1 << i
+        masks[name] = full_mask // ((1 << (2 * block)) - 1) * (((1 << block) - 1) << block)
+
+    # Subformulas are shared through hash-consing, so each distinct node is evaluated once. Nodes are evaluated
+    # bottom-up from an explicit stack, like formula_to_string, so deeply nested formulas do not hit the recursion limit
+    values: Dict[int, int] = {}
+
+    def evaluate_node(formula: Formula) -> int:
+        if isinstance(formula, Atom):
+            return masks[formula.name]
+        elif isinstance(formula, Not):
+            return full_mask ^ values[id(formula.formula)]
+        elif isinstance(formula, And):
+            result = full_mask
+            for conj in formula.conjuncts:
+                result &= values[id(conj)]
+            return result
+        elif isinstance(formula, Or):
+            result = 0
+            for disj in formula.disjuncts:
+                result |= values[id(disj)]
+            return result
+        return (full_mask ^ values[id(formula.left)]) | values[id(formula.right)]
+
+    stack = [formula]
+    while stack:
+        node = stack[-1]
+        if id(node) in values:
+            stack.pop()
+            continue
+        if not isinstance(node, (Atom, Not, And, Or, Implies)):
+            raise ValueError(f"Not a propositional formula: {formula_to_string(node)}")
+        pending = [child for child in _CHILDREN[type(node)](node) if id(child) not in values]
+        if pending:
+            stack.extend(pending)
+        else:
+            stack.pop()
+            values[id(node)] = evaluate_node(node)
+    return values[id(formula)]
+
+
+# The formula classes occurring anywhere in a formula, read off its distinct subformulas
+def connectives(formula: Formula) -> FrozenSet[type]:
+    return frozenset(type(node) for node in subformulas(formula))
+
+
+# A formula without modal operators only ever lives in the root world
+def is_modal(formula: Formula) -> bool:
+    return any(isinstance(node, (Box, Diamond)) for node in subformulas(formula))
+
+
+# Truth table bitmask of a propositional formula together with the all-true mask, or None when a tableau is needed
+def propositional_truth(formula: Formula) -> Optional[Tuple[int, int]]:
+    nodes = subformulas(formula)
+    if any(isinstance(node, (Box, Diamond)) for node in nodes):
+        return None
+    atoms = sorted({node.name for node in nodes if isinstance(node, Atom)})
+    if len(atoms) > MAX_TRUTH_TABLE_ATOMS:
+        return None
+    return truth_table_mask(formula, atoms), (1 << (1 << len(atoms))) - 1
+
+
+# Clauses saying that a propositional formula is true (sign True) or false (sign False), by Tseitin's encoding: each
+# distinct compound subformula gets a variable defined to be equivalent to it, so the clause set grows linearly with the
+# formula instead of blowing up through distribution. Literals are signed variable numbers; negation needs no variable
+def tseitin_clauses(formula: Formula, sign: bool) -> List[FrozenSet[int]]:
+    literals: Dict[int, int] = {}
+    clauses: List[FrozenSet[int]] = []
+    variables = itertools.count(1)
+
+    # Literal of a subformula whose operands already have theirs, adding the clauses that define its variable
+    def literal(formula: Formula) -> int:
+        if isinstance(formula, Not):
+            return -literals[id(formula.formula)]
+        result = next(variables)
+        if isinstance(formula, (And, Or)):
+            operands = [literals[id(operand)] for operand in _CHILDREN[type(formula)](formula)]
+            # A conjunction implies each operand and is implied by all of them; a disjunction dually
+            polarity = 1 if isinstance(formula, And) else -1
+            clauses.extend(frozenset((-polarity * result, polarity * operand)) for operand in operands)
+            clauses.append(frozenset([polarity * result] + [-polarity * operand for operand in operands]))
+        elif isinstance(formula, Implies):
+            left, right = literals[id(formula.left)], literals[id(formula.right)]
+            clauses.extend([frozenset((-result, -left, right)), frozenset((result, left)), frozenset((result, -right))])
+        return result
+
+    # Subformulas are encoded bottom-up from an explicit stack, so deeply nested formulas do not hit the recursion limit
+    stack = [formula]
+    while stack:
+        node = stack[-1]
+        if id(node) in literals:
+            stack.pop()
+            continue
+        if not isinstance(node, (Atom, Not, And, Or, Implies)):
+            raise ValueError(f"Not a propositional formula: {formula_to_string(node)}")
+        pending = [child for child in _CHILDREN[type(node)](node) if id(child) not in literals]
+        if pending:
+            stack.extend(pending)
+        else:
+            stack.pop()
+            literals[id(node)] = literal(node)
+
+    root = literals[id(formula)]
+    clauses.append(frozenset((root if sign else -root,)))
+    return clauses
+
+
+# DPLL on an assignment that is extended and undone in place: each assigned literal is recorded on a trail, so
+# backtracking only pops the trail instead of copying clause lists. Assigning a literal visits just the clauses that
+# contain it or its negation, through an occurrence index: it keeps a count of the still open clauses each literal is in
+# up to date, and queues any clause it leaves with one unassigned literal. Literals whose negation is in no open clause
+# are assigned without a split
+def dpll(clauses: List[FrozenSet[int]]) -> bool:
+    clauses = [tuple(clause) for clause in clauses]
+    if not all(clauses):
+        return False
+    occurrences: Dict[int, List[int]] = defaultdict(list)
+    open_counts: Dict[int, int] = defaultdict(int)
+    for index, clause in enumerate(clauses):
+        for literal in clause:
+            occurrences[literal].append(index)
+            open_counts[literal] += 1
+    variables = {abs(literal) for literal in occurrences}
+    true_counts = [0] * len(clauses)
+    open_clauses = len(clauses)
+    assignment: Dict[int, bool] = {}
+    trail: List[int] = []
+
+    # Assign a literal and everything unit propagation forces with it. Returns False on a conflict
+    def assign(literal: int) -> bool:
+        nonlocal open_clauses
+        queue = [literal]
+        while queue:
+            literal = queue.pop()
+            value = assignment.get(abs(literal))
+            if value is not None:
+                if value != (literal > 0):
+                    return False
+                continue
+            assignment[abs(literal)] = literal > 0
+            trail.append(literal)
+            for index in occurrences[literal]:
+                true_counts[index] += 1
+                if true_counts[index] == 1:
+                    open_clauses -= 1
+                    for other in clauses[index]:
+                        open_counts[other] -= 1
+            for index in occurrences[-literal]:
+                if true_counts[index]:
+                    continue
+                unassigned = [other for other in clauses[index] if abs(other) not in assignment]
+                if not unassigned:
+                    return False
+                if len(unassigned) == 1:
+                    queue.append(unassigned[0])
+        return True
+
+    def undo(trail_length: int):
+        nonlocal open_clauses
+        while len(trail) > trail_length:
+            literal = trail.pop()
+            del assignment[abs(literal)]
+            for index in occurrences[literal]:
+                true_counts[index] -= 1
+                if not true_counts[index]:
+                    open_clauses += 1
+                    for other in clauses[index]:
+                        open_counts[other] += 1
+
+    def search() -> bool:
+        while True:
+            if not open_clauses:
+                return True
+            unassigned = [variable for variable in variables if variable not in assignment]
+            pure = [variable if open_counts[variable] else -variable for variable in unassigned
+                    if bool(open_counts[variable]) != bool(open_counts[-variable])]
+            if not pure:
+                break
+            for literal in pure:
+                assign(literal)  # Its negation is in no open clause, so this cannot conflict
+
+        # Split on the variable occurring most often in the open clauses
+        variable = max(unassigned, key=lambda variable: open_counts[variable] + open_counts[-variable])
+        for literal in (variable, -variable):
+            trail_length = len(trail)
+            if assign(literal) and search():
+                return True
+            undo(trail_length)
+        return False
+
+    return all(assign(clause[0]) for clause in clauses if len(clause) == 1) and search()
+
+
+# Whether a root branch holding the given signed propositional formula closes, or None when a tableau is needed. Small
+# formulas are decided by their truth table, larger ones by DPLL on their clauses
+def propositional_closes(formula: Formula, sign: bool) -> Optional[bool]:
+    truth = propositional_truth(formula)
+    if truth is not None:
+        truth_mask, full_mask = truth
+        return truth_mask == 0 if sign else truth_mask == full_mask
+    if is_modal(formula):
+        return None
+    return not dpll(tseitin_clauses(formula, sign))
+
+
+Branch = List[Tuple[bool, int, Formula]]
+
+# Worlds are integer ids; their dotted prefix names ("1", "1.2", ...) are only materialized for display
+ROOT_WORLD = 0
+
+# Sequent cache status for a branch that has been expanded but not yet saturated
+PENDING = None
+
+# Expansion phase of each (formula class, sign): F [] and T <> create worlds first, then the propositional rules run,
+# and T [] is applied last, once the worlds it ranges over exist. Atoms and F <> have no phase and are never expanded
+NEW_WORLD_PHASE, PROPOSITIONAL_PHASE, DEFERRED_PHASE = range(3)
+_RULE_PHASES = {(cls, sign): PROPOSITIONAL_PHASE for cls in (Not, And, Or, Implies) for sign in (True, False)}
+_RULE_PHASES.update({
+    (Box, False): NEW_WORLD_PHASE,
+    (Diamond, True): NEW_WORLD_PHASE,
+    (Box, True): DEFERRED_PHASE,
+})
+
+# Verdicts of fully searched root sequents, keyed by (sign, formula, max_iterations) and shared by every Tableaux, so
+# checking a formula again skips the search. Only searches starting from the root world alone are shared, as worlds
+# left by an earlier check on the same instance take part in the next one. Bounded as an LRU
+_ROOT_VERDICTS: "OrderedDict[Tuple[bool, Formula, int], bool]" = OrderedDict()
+_ROOT_VERDICTS_LOCK = threading.Lock()
+MAX_ROOT_VERDICTS = 4096
 
 
 class Tableaux:
-    def __init__(self, formula: Formula):
+    def __init__(self, formula: Formula, timeout: Optional[float] = None):
         self.branches = None
         self.formula = formula
-        self.node_count = 0
-        self.expanded_prefixes = set()
-        self.current_prefix = "1"
-        self.tree = {}
+        self.current_prefix = ROOT_WORLD
+        self.world_names: List[str] = ["1"]
+        self.world_parents: List[int] = [-1]
+        # Tableau tree as parallel arrays indexed by node id; node 0 is the root. Nodes keep their branch, and labels are
+        # only formatted when the tree is printed or drawn
+        self.node_branches: List[Branch] = []
+        self.node_children: List[List[int]] = []
+        self.node_parents: List[int] = []
         self.accessibility = defaultdict(set)
-        self.accessibility["1"] = set()
+        self.accessibility[ROOT_WORLD] = set()
         self.deferred_expansions = []
         self.new_world_created = False
-        self.graph = pydot.Dot(graph_type='digraph')
-        self.graph.set_rankdir('TB')
-        self.graph.set_size("12,16!")
-        self.graph.set_margin(0.5)
-        self.graph.set_graph_defaults(nodesep='0.7', ranksep='1.0')
-        self.graph.set_node_defaults(shape='ellipse', style='filled', fillcolor='lightblue',
-                                     width='2.5', height='1.2', fontsize='14')
-        self.graph.set_edge_defaults(arrowhead='vee', arrowsize='0.9', penwidth='1.2')
+        self.sequent_cache: Dict[int, Optional[bool]] = {}
+        self.entry_bits: Dict[Tuple[int, int], int] = {}
+        self.atom_bits = 0
+        self.closed_keys: Dict[Optional[int], dict] = {}  # Set-trie of closed sequent keys, see settle_closed
+        self.leaf_keys: Dict[int, int] = {}  # Sequent keys of the branches expansion returned, by branch id
+        self.deferred_tableau = None
+        self.stop_at_open = False
+        self.partial_search = None  # Worlds and tree size to rewind to before a search that stopped early is redone
+        # Seconds each expansion may run for, or None for no limit. The search checks its deadline itself, so a timed
+        # out search really stops instead of running on in the background
+        self.timeout = timeout
+        self.deadline: Optional[float] = None
+        self.graph = None  # DOT source, only built from the tree arrays when the tableau is rendered
+        self.renders: Dict[str, bytes] = {}  # Graphviz output of that source per format
 
     def get_tableau_structure(self):
+        self.expand_deferred_tableau()
+
         def build_structure(node_id):
-            node = self.tree[node_id]
             return {
-                'label': node['label'],
-                'children': [build_structure(child_id) for child_id in node['children']]
+                'label': self.node_label(node_id),
+                'children': [build_structure(child_id) for child_id in self.node_children[node_id]]
             }
 
-        root = next(iter(self.tree))
-        return build_structure(root)
+        return build_structure(0)
 
     # Checking Validity
     def check_validity(self, max_iterations=1000):
-        self.branches = [[(False, "1", self.formula)]]
+        self.branches = [[(False, ROOT_WORLD, self.formula)]]
         return self.solve(max_iterations)
 
-    # Checking Satisfiability
+    # Checking Satisfiability. Known behaviour: a solver reused after check_validity also searches over the worlds that
+    # check created, so it reports e.g. [](p & ~p) unsatisfiable, while fresh solvers and check_both give the K verdict
     def check_satisfiability(self, max_iterations=1000):
-        self.branches = [[(True, "1", self.formula)]]
+        self.branches = [[(True, ROOT_WORLD, self.formula)]]
         return not self.solve(max_iterations)
 
+    # Checking validity and satisfiability together: a propositional formula needs one truth table for both, and a
+    # valid formula is satisfiable, so only the searches that are still undecided are run. Tableaux whose verdict is
+    # already known are expanded only if they are printed or drawn
+    @classmethod
+    def check_both(cls, formula: Formula, max_iterations=1000, timeout: Optional[float] = None):
+        validity_solver, satisfiability_solver = cls(formula, timeout), cls(formula, timeout)
+        validity_solver.branches = [[(False, ROOT_WORLD, formula)]]
+        satisfiability_solver.branches = [[(True, ROOT_WORLD, formula)]]
+
+        truth = propositional_truth(formula)
+        if truth is not None:
+            truth_mask, full_mask = truth
+            is_valid, is_satisfiable = truth_mask == full_mask, truth_mask != 0
+            validity_solver.deferred_tableau = (validity_solver.branches, max_iterations)
+            satisfiability_solver.deferred_tableau = (satisfiability_solver.branches, max_iterations)
+        else:
+            is_valid = validity_solver.solve(max_iterations)
+            if is_valid:
+                is_satisfiable = True
+                satisfiability_solver.deferred_tableau = (satisfiability_solver.branches, max_iterations)
+            else:
+                is_satisfiable = not satisfiability_solver.solve(max_iterations)
+        return is_valid, is_satisfiable, validity_solver, satisfiability_solver
+
     # Checking the solution has contradictions or not
     def solve(self, max_iterations):
-        for iteration in range(max_iterations):
-            print(f"Iteration {iteration}, branches: {len(self.branches)}")
-            self.new_world_created = False  # Reset the new world creation flag
-            new_branches = self.expand()
-
-            if new_branches == self.branches:
-                print("No more expansions possible")
-                break
-
-            # Apply deferred expansions if no new world has been created
-            if not self.new_world_created:
-                self.apply_deferred_expansions()
-
-            self.branches = new_branches
+        # A tableau of an earlier check on this instance that was deferred, or stopped early, is finished first, so
+        # every check leaves the same worlds behind for the next one whether or not its verdict was known in advance
+        if self.deferred_tableau is not None and (self.partial_search is not None or is_modal(self.formula)):
+            branches = self.branches
+            self.expand_deferred_tableau()
+            self.branches = branches
+        self.deferred_tableau = None
+        all_closed = self.solve_propositional()
+        root_key = None
+        if (all_closed is None and len(self.branches) == 1 and len(self.branches[0]) == 1
+                and len(self.world_names) == 1 and not self.accessibility[ROOT_WORLD]):
+            sign, _, formula = self.branches[0][0]
+            root_key = (sign, formula, max_iterations)
+            with _ROOT_VERDICTS_LOCK:
+                all_closed = _ROOT_VERDICTS.get(root_key)
+                if all_closed is not None:
+                    _ROOT_VERDICTS.move_to_end(root_key)
+        if all_closed is not None:
+            # The verdict is known; the tableau itself is only expanded if it is printed or drawn
+            self.deferred_tableau = (self.branches, max_iterations)
+            return all_closed
+
+        all_closed = self.expand_tableau(max_iterations, stop_at_open=True)
+        if root_key is not None:
+            with _ROOT_VERDICTS_LOCK:
+                _ROOT_VERDICTS[root_key] = all_closed
+                if len(_ROOT_VERDICTS) > MAX_ROOT_VERDICTS:
+                    _ROOT_VERDICTS.popitem(last=False)
+        return all_closed
 
-        self.build_tree()  # Build the tree after expansion is complete
+    # Decide a single-root propositional branch without the tableau. Returns None when the tableau is needed
+    def solve_propositional(self) -> Optional[bool]:
+        if len(self.branches) != 1 or len(self.branches[0]) != 1:
+            return None
+        sign, _, formula = self.branches[0][0]
+        return propositional_closes(formula, sign)
+
+    def expand_deferred_tableau(self):
+        if self.deferred_tableau is not None:
+            self.branches, max_iterations = self.deferred_tableau
+            self.deferred_tableau = None
+            if self.partial_search is not None:
+                self.rewind_search(*self.partial_search)
+                self.partial_search = None
+            self.expand_tableau(max_iterations)
+
+    def rewind_search(self, world_count, accessibility, node_count):
+        del self.world_names[world_count:]
+        del self.world_parents[world_count:]
+        self.accessibility = defaultdict(set, accessibility)
+        del self.node_branches[node_count:]
+        del self.node_children[node_count:]
+        del self.node_parents[node_count:]
+
+    # With stop_at_open the search ends at the first saturated open branch. The tableau cannot close then, and the full
+    # tableau is deferred until it is printed or drawn, starting again from the worlds and tree this search started with
+    def expand_tableau(self, max_iterations, stop_at_open=False):
+        self.deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        self.sequent_cache.clear()
+        self.closed_keys.clear()
+        self.leaf_keys.clear()
+        self.graph = None
+        self.renders.clear()
+        self.stop_at_open = stop_at_open
+        checkpoint = None
+        if stop_at_open:
+            checkpoint = (len(self.world_names), {world: set(worlds) for world, worlds in self.accessibility.items()},
+                          len(self.node_branches))
+        root_branches = self.branches
+        try:
+            for iteration in range(max_iterations):
+                logger.debug("Iteration %d, branches: %d", iteration, len(self.branches))
+                self.new_world_created = False  # Reset the new world creation flag
+                new_branches = self.expand()
+
+                # Apply deferred expansions if no new world has been created
+                if not self.new_world_created:
+                    self.apply_deferred_expansions()
+
+                self.branches = new_branches
+
+                # Stop once every branch is settled in the sequent cache, i.e. closed or saturated
+                if all(self.sequent_cache.get(self.leaf_key(branch), PENDING) is not PENDING
+                       for branch in new_branches):
+                    logger.debug("No more expansions possible")
+                    break
+        except _OpenBranchFound:
+            logger.debug("Open branch found, the tableau does not close")
+            self.deferred_tableau = (root_branches, max_iterations)
+            self.partial_search = checkpoint
+            return False
 
         # Check if all branches are closed
-        all_closed = all(is_closed(branch, self.accessibility) for branch in self.branches)
+        all_closed = all(self.is_branch_closed(branch) for branch in self.branches)
         return all_closed
 
+    def is_branch_closed(self, branch: Branch) -> bool:
+        key = self.leaf_key(branch)
+        status = self.sequent_cache.get(key, PENDING)
+        if status is PENDING:
+            return self.is_closed_key(key)
+        return status
+
     # Deferred Branching for T[] and F<>
     def apply_deferred_expansions(self):
         """Process the deferred expansions for T [] and F <> formulas"""
-        print(f"Processing deferred expansions: {len(self.deferred_expansions)}")
+        logger.debug("Processing deferred expansions: %d", len(self.deferred_expansions))
         deferred_branches = []
         for branch in self.deferred_expansions:
             expanded_branches = self.expand_branch(branch)
@@ -179,144 +609,277 @@ class Tableaux:
         self.branches.extend(deferred_branches)
         self.deferred_expansions.clear()  # Clear deferred expansions after processing
 
+    # Canonical cache key for a branch: a bitset over the prefixed formulas seen in this tableau, where each one owns a
+    # pair of adjacent bits, the even one for T and the odd one for F. Every formula on a branch is a subformula of the
+    # root formula, so ids are stable
+    def sequent_key(self, branch: Branch) -> int:
+        entry_bit = self.entry_bit
+        key = 0
+        for entry in branch:
+            key |= entry_bit(entry)
+        return key
+
+    def entry_bit(self, entry: Tuple[bool, int, Formula]) -> int:
+        sign, prefix, formula = entry
+        bit = self.entry_bits.get((prefix, id(formula)))
+        if bit is None:
+            bit = self.entry_bits[(prefix, id(formula))] = 1 << (2 * len(self.entry_bits))
+            if isinstance(formula, Atom):
+                self.atom_bits |= bit
+        return bit if sign else bit << 1
+
+    # Key of a branch with its i-th entry taken out, derived from the key of the whole branch rather than by rekeying
+    # the rest of it. Branches never hold the same entry twice, so that entry's bit is simply cleared
+    def key_without(self, key: int, branch: Branch, i: int) -> int:
+        return key & ~self.entry_bit(branch[i])
+
+    # Successor of a branch whose entry between head and tail was expanded into new_entries, together with its key.
+    # New entries that are already on the branch are left out, which keeps every branch free of duplicates
+    def successor(self, head: Branch, new_entries: Branch, tail: Branch, rest_key: int) -> Tuple[Branch, int]:
+        key = rest_key
+        added = []
+        for entry in new_entries:
+            bit = self.entry_bit(entry)
+            if not key & bit:
+                key |= bit
+                added.append(entry)
+        return head + added + tail, key
+
+    # Branches returned by expansion are alive in the tree for the whole search, so their keys are recorded once and
+    # looked up again by id instead of every ancestor and iteration rekeying them
+    def leaf_key(self, branch: Branch) -> int:
+        key = self.leaf_keys.get(id(branch))
+        return self.sequent_key(branch) if key is None else key
+
+    # Checking for a closed branch: some atom is both true and false in the same world, i.e. both bits of its pair
+    # are set in the sequent key
+    def is_closed_key(self, key: int) -> bool:
+        return key & (key >> 1) & self.atom_bits != 0
+
+    # Once every branch a sequent expanded into is closed, the sequent itself is closed. It is stored in a set-trie,
+    # one level per set bit from the lowest up and a None entry where a key ends, so that any later branch containing
+    # all of its formulas is closed on sight
+    def settle_closed(self, key: int, expanded_branches: List[Branch]) -> List[Branch]:
+        if expanded_branches and all(self.sequent_cache.get(self.leaf_key(expanded_branch)) is True
+                                     for expanded_branch in expanded_branches):
+            self.sequent_cache[key] = True
+            node = self.closed_keys
+            remaining = key
+            while remaining:
+                lowest_bit = remaining & -remaining
+                node = node.setdefault(lowest_bit, {})
+                remaining ^= lowest_bit
+            node[None] = {}
+        return expanded_branches
+
+    # Checking whether a sequent contains a sequent already known to be closed: only the paths of the set-trie whose
+    # bits are all in the sequent are followed
+    def subsumes_closed(self, key: int) -> bool:
+        nodes = [self.closed_keys]
+        while nodes:
+            node = nodes.pop()
+            if None in node:
+                return True
+            nodes.extend(child for bit, child in node.items() if key & bit)
+        return False
+
+    # Global sequent cache: saturated branches are not re-expanded and duplicate branches are pruned
     def expand(self):
         new_branches = []
         for branch in self.branches:
-            expanded_branches = self.expand_branch(branch)
-            new_branches.extend(expanded_branches)
+            key = self.leaf_key(branch)
+            if key in self.sequent_cache:
+                if self.sequent_cache[key] is not PENDING:
+                    new_branches.append(branch)
+                continue
+
+            self.sequent_cache[key] = PENDING
+            new_branches.extend(self.expand_branch(branch))
         return new_branches
 
     # Tableaux Tree Branching
-    def expand_branch(self, branch, depth=0, parent_id=None):
-        print(
-            f"\nExpanding branch at depth {depth}: {[(prefix, 'T' if sign else 'F', Tableaux.formula_to_string(formula)) for sign, prefix, formula in branch]}")
+    def expand_branch(self, branch, depth=0, parent_id=None, key=None):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Expanding branch at depth %d: %s", depth, self.describe_branch(branch))
+
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise TimeoutError(f"Tableau expansion timed out after {self.timeout} seconds")
 
         if depth > 100:  # Prevent infinite recursion
-            print(f"Warning: Maximum recursion depth reached for branch: {branch}")
+            logger.warning("Maximum recursion depth reached for branch: %s", branch)
             return [branch]
 
         node_id = self.add_node(branch, parent_id)
+        if key is None:
+            # Successors are checked for closure before they get here; other branches are checked before decomposing
+            key = self.sequent_key(branch)
+            if self.is_closed_key(key) or self.subsumes_closed(key):
+                logger.debug("Branch closed, not expanding further")
+                self.sequent_cache[key] = True
+                self.leaf_keys[id(branch)] = key
+                return [branch]
+
+        phases = [_RULE_PHASES.get((type(formula), sign)) for sign, _, formula in branch]
 
         # First, expand all F [] and T <> formulas
-        f_box_formulas = [(i, (sign, prefix, formula)) for i, (sign, prefix, formula) in enumerate(branch)
-                          if isinstance(formula, Box) and not sign or isinstance(formula, Diamond) and sign]
+        f_box_formulas = [(i, entry) for i, entry in enumerate(branch) if phases[i] == NEW_WORLD_PHASE]
 
         for i, (sign, prefix, formula) in f_box_formulas:
             result = self.apply_rule(sign, prefix, formula)
             if result:
+                head, tail = branch[:i], branch[i + 1:]
+                rest_key = self.key_without(key, branch, i)
                 for new_branch in result:
-                    new_full_branch = branch[:i] + new_branch + branch[i + 1:]
-                    expanded_branches = self.expand_branch(new_full_branch, depth + 1, node_id)
+                    new_full_branch, new_key = self.successor(head, new_branch, tail, rest_key)
+                    expanded_branches = self.expand_successor(new_full_branch, depth + 1, node_id, new_key)
                     if expanded_branches:
-                        return expanded_branches
+                        return self.settle_closed(key, expanded_branches)
 
         # Then, expand other formulas
         for i, (sign, prefix, formula) in enumerate(branch):
-            if isinstance(formula, Atom):
-                print(f"Atom found in branch, skipping: {Tableaux.formula_to_string(formula)}")
-                continue  # Skip atomic formulas
-
-            if isinstance(formula, Box) and sign or isinstance(formula, Diamond) and not sign:
-                # Defer expansion of T [] and F <> formulas
+            if phases[i] != PROPOSITIONAL_PHASE:
+                # Atoms are never expanded, and T [] and F <> formulas are deferred
                 continue
 
             result = self.apply_rule(sign, prefix, formula)
 
             if result:
-                print(f"Formula expanded into: {result}")
+                logger.debug("Formula expanded into: %s", result)
                 expanded_branches = []
+                # Slice and key the untouched parts of the branch once and share them between all successors, so each
+                # successor's key only has to add the bits of its new formulas
+                head, tail = branch[:i], branch[i + 1:]
+                rest_key = self.key_without(key, branch, i)
                 for new_branch in result:
-                    new_full_branch = branch[:i] + new_branch + branch[i + 1:]
-                    print(
-                        f"New full branch after expansion: {[(prefix, 'T' if sign else 'F', Tableaux.formula_to_string(formula)) for sign, prefix, formula in new_full_branch]}")
-
-                    if isinstance(formula, Or) and sign:
-                        for sub_branch in new_branch:
-                            expanded_branches.extend(
-                                self.expand_branch([sub_branch] + new_full_branch[i + 1:], depth + 1, node_id))
-                    else:
-                        expanded_branches.extend(self.expand_branch(new_full_branch, depth + 1, node_id))
-                return expanded_branches
+                    new_full_branch, new_key = self.successor(head, new_branch, tail, rest_key)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("New full branch after expansion: %s", self.describe_branch(new_full_branch))
+
+                    expanded_branches.extend(self.expand_successor(new_full_branch, depth + 1, node_id, new_key))
+                return self.settle_closed(key, expanded_branches)
 
         # If no expansion was possible, expand deferred T [] formulas
-        t_box_formulas = [(i, (sign, prefix, formula)) for i, (sign, prefix, formula) in enumerate(branch)
-                          if isinstance(formula, Box) and sign or isinstance(formula, Diamond) and sign]
+        t_box_formulas = [(i, entry) for i, entry in enumerate(branch) if phases[i] == DEFERRED_PHASE]
 
         for i, (sign, prefix, formula) in t_box_formulas:
             result = self.apply_rule(sign, prefix, formula)
             if result:
+                head, tail = branch[:i], branch[i + 1:]
+                rest_key = self.key_without(key, branch, i)
                 for new_branch in result:
-                    new_full_branch = branch[:i] + new_branch + branch[i + 1:]
-                    expanded_branches = self.expand_branch(new_full_branch, depth + 1, node_id)
+                    new_full_branch, new_key = self.successor(head, new_branch, tail, rest_key)
+                    expanded_branches = self.expand_successor(new_full_branch, depth + 1, node_id, new_key)
                     if expanded_branches:
-                        return expanded_branches
-
-        # If no expansion was possible, return the branch as is
-        print(
-            f"No expansion possible for branch, returning as is: {[(prefix, 'T' if sign else 'F', Tableaux.formula_to_string(formula)) for sign, prefix, formula in branch]}")
+                        return self.settle_closed(key, expanded_branches)
+
+        # If no expansion was possible, the branch is saturated: settle it in the cache and return it as is
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("No expansion possible for branch, returning as is: %s", self.describe_branch(branch))
+        closed = self.sequent_cache[key] = self.is_closed_key(key)
+        self.leaf_keys[id(branch)] = key
+        if not closed and self.stop_at_open:
+            raise _OpenBranchFound
         return [branch]
 
-    # Propositional and Modal logic rules application
-    def apply_rule(self, sign: bool, prefix: str, formula: Formula) -> List[List[Tuple[bool, str, Formula]]]:
-        print(f"Applying rule to: {'T' if sign else 'F'} {prefix} {self.formula_to_string(formula)}")
-
-        if isinstance(formula, Atom):
-            return []  # No expansion needed for atomic formulas
-
-        elif isinstance(formula, Not):
-            return [[(not sign, prefix, formula.formula)]]
-
-        elif isinstance(formula, And):
-            if sign:
-                return [[(True, prefix, conj) for conj in formula.conjuncts]]
-            else:
-                return [[(False, prefix, conj)] for conj in formula.conjuncts]
+    # Expand a successor branch unless it is already closed, or the same sequent was already settled on another branch,
+    # in which case that result is shared instead of being expanded again
+    def expand_successor(self, branch, depth, parent_id, key=None):
+        if key is None:
+            key = self.sequent_key(branch)
+        if self.is_closed_key(key) or self.subsumes_closed(key):
+            logger.debug("Branch closed, not expanding further")
+            self.add_node(branch, parent_id)
+            self.sequent_cache[key] = True
+            self.leaf_keys[id(branch)] = key
+            return [branch]
+        if self.sequent_cache.get(key, PENDING) is not PENDING:
+            logger.debug("Sequent already settled, sharing its result")
+            self.add_node(branch, parent_id)
+            self.leaf_keys[id(branch)] = key
+            return [branch]
+        return self.expand_branch(branch, depth, parent_id, key)
 
-        elif isinstance(formula, Or):
-            if sign:
-                return [[(True, prefix, disj)] for disj in formula.disjuncts]
-            else:
-                return [[(False, prefix, disj) for disj in formula.disjuncts]]
+    # Readable form of a branch for the expansion trace
+    def describe_branch(self, branch: Branch) -> List[Tuple[str, str, str]]:
+        return [(self.world_names[prefix], 'T' if sign else 'F', Tableaux.formula_to_string(formula))
+                for sign, prefix, formula in branch]
 
-        elif isinstance(formula, Implies):
-            if sign:
-                return [[(False, prefix, formula.left)], [(True, prefix, formula.right)]]
-            else:
-                return [[(True, prefix, formula.left), (False, prefix, formula.right)]]
-
-        elif isinstance(formula, Box):
-            if sign:
-                result = []
-                for accessible_world in self.accessibility[prefix]:
-                    result.append((True, accessible_world, formula.formula))
-                return [result] if result else []
-            else:
-                new_world = f"{prefix}.{len(self.accessibility[prefix]) + 1}"
-                self.accessibility[prefix].add(new_world)
-                self.new_world_created = True
-                return [[(False, new_world, formula.formula)]]
-
-        elif isinstance(formula, Diamond):
-            if sign:
-                new_world = f"{prefix}.{len(self.accessibility[prefix]) + 1}"
-                self.accessibility[prefix].add(new_world)
-                self.new_world_created = True
-                return [[(True, new_world, formula.formula)]]
-            else:
-                result = []
-                for accessible_world in self.accessibility[prefix]:
-                    result.append((False, accessible_world, formula.formula))
-                return [result] if result else []
+    # Propositional and Modal logic rules application
+    def apply_rule(self, sign: bool, prefix: int, formula: Formula) -> List[Branch]:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Applying rule to: %s %s %s", 'T' if sign else 'F', self.world_names[prefix],
+                         self.formula_to_string(formula))
+        return self._RULES[type(formula)](self, sign, prefix, formula)
+
+    def _apply_atom(self, sign: bool, prefix: int, formula: Atom) -> List[Branch]:
+        return []  # No expansion needed for atomic formulas
+
+    # A chain of negations is stripped in a single step, flipping the sign once per negation
+    def _apply_not(self, sign: bool, prefix: int, formula: Not) -> List[Branch]:
+        while type(formula) is Not:
+            sign, formula = not sign, formula.formula
+        return [[(sign, prefix, formula)]]
+
+    def _apply_and(self, sign: bool, prefix: int, formula: And) -> List[Branch]:
+        if sign:
+            return [[(True, prefix, conj) for conj in formula.conjuncts]]
+        return [[(False, prefix, conj)] for conj in formula.conjuncts]
+
+    def _apply_or(self, sign: bool, prefix: int, formula: Or) -> List[Branch]:
+        if sign:
+            return [[(True, prefix, disj)] for disj in formula.disjuncts]
+        return [[(False, prefix, disj) for disj in formula.disjuncts]]
+
+    def _apply_implies(self, sign: bool, prefix: int, formula: Implies) -> List[Branch]:
+        if sign:
+            return [[(False, prefix, formula.left)], [(True, prefix, formula.right)]]
+        return [[(True, prefix, formula.left), (False, prefix, formula.right)]]
+
+    def _apply_box(self, sign: bool, prefix: int, formula: Box) -> List[Branch]:
+        if sign:
+            result = [(True, accessible_world, formula.formula) for accessible_world in self.accessibility[prefix]]
+            return [result] if result else []
+        return [[(False, self.new_world(prefix), formula.formula)]]
+
+    def _apply_diamond(self, sign: bool, prefix: int, formula: Diamond) -> List[Branch]:
+        if sign:
+            return [[(True, self.new_world(prefix), formula.formula)]]
+        result = [(False, accessible_world, formula.formula) for accessible_world in self.accessibility[prefix]]
+        return [result] if result else []
+
+    _RULES = {Atom: _apply_atom, Not: _apply_not, And: _apply_and, Or: _apply_or, Implies: _apply_implies,
+              Box: _apply_box, Diamond: _apply_diamond}
+
+    # Allocate a fresh world accessible from the given one
+    def new_world(self, prefix: int) -> int:
+        new_world = len(self.world_names)
+        self.world_names.append(f"{self.world_names[prefix]}.{len(self.accessibility[prefix]) + 1}")
+        self.world_parents.append(prefix)
+        self.accessibility[prefix].add(new_world)
+        self.new_world_created = True
+        return new_world
+
+    # Accessibility relation keyed by world names, for printing and drawing
+    def named_accessibility(self) -> Dict[str, Set[str]]:
+        self.expand_deferred_tableau()  # Worlds are only created once the tableau is expanded
+        names = self.world_names
+        return {names[world]: {names[accessible_world] for accessible_world in accessible_worlds}
+                for world, accessible_worlds in self.accessibility.items()}
 
     def print_accessibility(self):
+        accessibility = self.named_accessibility()
         print("\nKripke World Relationships:")
-        for world in sorted(self.accessibility.keys()):
-            accessible_worlds = sorted(self.accessibility[world])
-            if len(accessible_worlds) == 1 and accessible_worlds[0] == world:
+        reflexive_worlds = []  # Collected in the same pass, already in sorted order
+        for world in sorted(accessibility):
+            reflexive = world in accessibility[world]
+            if reflexive:
+                reflexive_worlds.append(world)
+            accessible_worlds = sorted(accessibility[world])
+            if len(accessible_worlds) == 1 and reflexive:
                 print(f"World {world}: reflexive, no other accessible worlds")
             else:
                 other_worlds = [w for w in accessible_worlds if w != world]
-                if world in accessible_worlds:
+                if reflexive:
                     if other_worlds:
                         print(f"World {world}: reflexive, can access {', '.join(other_worlds)}")
                     else:
@@ -327,23 +890,26 @@ class Tableaux:
                     print(f"World {world}: no accessible worlds")
 
         print("\nReflexive worlds:")
-        reflexive_worlds = [world for world, accessible in self.accessibility.items() if world in accessible]
         if reflexive_worlds:
-            print(", ".join(sorted(reflexive_worlds)))
+            print(", ".join(reflexive_worlds))
         else:
             print("No reflexive worlds")
 
     # Visualize Kripke Accessibility Relation
     def visualize_accessibility(self):
         """Visualizes the Kripke model accessibility relations."""
+        import networkx as nx
+        from matplotlib import pyplot as plt
+
+        accessibility = self.named_accessibility()
         graph = nx.DiGraph()
 
         # Add nodes for each world
-        for world in self.accessibility:
+        for world in accessibility:
             graph.add_node(world)
 
         # Add edges based on accessibility relations, excluding self-loops
-        for world, accessible_worlds in self.accessibility.items():
+        for world, accessible_worlds in accessibility.items():
             for accessible_world in accessible_worlds:
                 if world != accessible_world:
                     graph.add_edge(world, accessible_world)
@@ -365,8 +931,8 @@ class Tableaux:
         nx.draw_networkx_edges(graph, pos, edge_color='gray', arrows=True,
                                arrowsize=20, arrowstyle='->', connectionstyle='arc3,rad=0.2')
 
-        for world in self.accessibility:
-            if world in self.accessibility[world]:
+        for world in accessibility:
+            if world in accessibility[world]:
                 # Calculate loop position for better visibility
                 loop_pos = pos[world]
                 loop_pos += 0.2  # Adjust the x-coordinate for offset
@@ -385,48 +951,78 @@ class Tableaux:
         plt.tight_layout()
         plt.show()
 
+    # DOT source of the tableau tree, written straight from the tree arrays. Building pydot objects first and having
+    # pydot serialise them took seconds once a tree reached a few thousand nodes
     def build_tree(self):
-        self.graph = pydot.Dot(graph_type='digraph')
-        self.graph.set_rankdir('TB')
-        self.graph.set_size("12,16!")
-        self.graph.set_margin(0.5)
-
-        self.graph.set_graph_defaults(nodesep='0.7', ranksep='1.0')
-        self.graph.set_node_defaults(shape='ellipse', style='filled', fillcolor='lightblue',
-                                     width='2.5', height='1.2', fontsize='14')
-        self.graph.set_edge_defaults(arrowhead='vee', arrowsize='0.9', penwidth='1.2')
-
-        if self.tree:
-            root = next(iter(self.tree))
-            self._build_tree_recursive(root)
+        lines = ['digraph G {', 'margin=0.5;', 'rankdir=TB;', 'size="12,16!";',
+                 'graph [nodesep="0.7", ranksep="1.0"];',
+                 'node [fillcolor=lightblue, fontsize=14, height="1.2", shape=ellipse, style=filled, width="2.5"];',
+                 'edge [arrowhead=vee, arrowsize="0.9", penwidth="1.2"];']
+        if self.node_branches:
+            self._build_tree_lines(lines)
         else:
             print("Warning: Empty tree, nothing to visualize")
-
-    def _build_tree_recursive(self, node_id):
-        node_data = self.tree[node_id]
-        label = node_data['label'].replace('\n', '\\n')
-        node = pydot.Node(node_id, label=label)
-        if node_id == next(iter(self.tree)):
-            node.set('pos', '0,0!')
-        self.graph.add_node(node)
-        for child_id in node_data['children']:
-            child_node = self._build_tree_recursive(child_id)
-            self.graph.add_edge(pydot.Edge(node, child_node))
-        return node
+        lines.append('}')
+        self.graph = '\n'.join(lines) + '\n'
+
+    # Depth-first from the root with an explicit stack, so deep tableaux do not hit the recursion limit. Each child's
+    # subtree is written before the edge to it, and the edge line waits on the stack until then
+    def _build_tree_lines(self, lines):
+        stack = [0]
+        while stack:
+            node_id = stack.pop()
+            if isinstance(node_id, str):  # An edge line whose child subtree is written
+                lines.append(node_id)
+                continue
+            label = self.node_label(node_id).replace('\n', '\\n').replace('"', '\\"')
+            position = ', pos="0,0!"' if node_id == 0 else ''
+            lines.append(f'node{node_id} [label="{label}"{position}];')
+            for child_id in reversed(self.node_children[node_id]):
+                stack.append(f'node{node_id} -> node{child_id};')
+                stack.append(child_id)
 
     # Creating nodes of tree
-    def add_node(self, formulas: List[Tuple[bool, str, Formula]], parent_id: str = None) -> str:
-        label = "\\n".join(
-            f"{prefix} {'T' if sign else 'F'} {self.formula_to_string(formula)}" for sign, prefix, formula in formulas)
-        node_id = f'node{self.node_count}'
-        self.tree[node_id] = {'label': label, 'children': [], 'parent': parent_id}
-        self.node_count += 1
-        if parent_id:
-            self.tree[parent_id]['children'].append(node_id)
+    def add_node(self, formulas: Branch, parent_id: Optional[int] = None) -> int:
+        node_id = len(self.node_branches)
+        self.node_branches.append(formulas)
+        self.node_children.append([])
+        self.node_parents.append(-1 if parent_id is None else parent_id)
+        if parent_id is not None:
+            self.node_children[parent_id].append(node_id)
         return node_id
 
+    def node_label(self, node_id: int) -> str:
+        return "\\n".join(f"{self.world_names[prefix]} {'T' if sign else 'F'} {self.formula_to_string(formula)}"
+                          for sign, prefix, formula in self.node_branches[node_id])
+
+    # Render the tableau straight to PNG bytes by piping the DOT source through dot's stdin/stdout
+    def graph_png(self) -> bytes:
+        return self.render_tree('png')
+
+    # Render the tableau as SVG markup, which the browser scales and draws without any image decoding server side
+    def graph_svg(self) -> str:
+        return self.render_tree('svg').decode('utf-8')
+
+    # The tree only changes when the tableau is expanded again, so each format is rendered by dot at most once per tree
+    def render_tree(self, output_format: str) -> bytes:
+        dot_source = self.tree_dot()
+        image = self.renders.get(output_format)
+        if image is None:
+            image = self.renders[output_format] = subprocess.run(
+                ['dot', f'-T{output_format}'], input=dot_source.encode('utf-8'), stdout=subprocess.PIPE,
+                check=True).stdout
+        return image
+
+    def tree_dot(self) -> str:
+        self.expand_deferred_tableau()
+        if self.graph is None:
+            self.build_tree()
+        return self.graph
+
     def save_graph(self, filename='tableau.png'):
-        self.graph.write_png(filename, prog='dot')
+        image = self.graph_png()
+        with open(filename, 'wb') as image_file:
+            image_file.write(image)
 
     # Saving graph locally and sending to client
     def save_graph_to_file(self) -> str:
@@ -434,199 +1030,221 @@ class Tableaux:
         try:
             with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_file:
                 temp_filename = tmp_file.name
-                logger.debug(f"Temporary file created: {temp_filename}")
-                self.graph.write_png(temp_filename)
-                logger.debug(f"Graph written to temporary file")
+                logger.debug("Temporary file created: %s", temp_filename)
+                tmp_file.write(self.graph_png())
+                logger.debug("Graph written to temporary file")
             return temp_filename
         except Exception as e:
-            logger.error(f"Error in save_graph_to_file: {str(e)}")
+            logger.error("Error in save_graph_to_file: %s", e)
             raise
 
     # Print Tableaux Branching
     def print_tableau(self):
+        self.expand_deferred_tableau()
         for i, branch in enumerate(self.branches):
             print(f"Branch {i}:")
             for sign, prefix, formula in branch:
-                print(f"  {prefix} {'T' if sign else 'F'} {self.formula_to_string(formula)}")
+                print(f"  {self.world_names[prefix]} {'T' if sign else 'F'} {self.formula_to_string(formula)}")
             print()
 
-    def save_accessibility_graph(self):
+    # Draws on a standalone Figure rather than pyplot's global current figure, so several graphs can be rendered
+    # from different threads at once
+    def draw_accessibility_graph(self) -> "Figure":
+        import networkx as nx
+        from matplotlib.figure import Figure
+
+        accessibility = self.named_accessibility()
         graph = nx.DiGraph()
 
         # Add nodes and edges
-        for world in self.accessibility:
+        for world in accessibility:
             graph.add_node(world)
-            for accessible_world in self.accessibility[world]:
+            for accessible_world in accessibility[world]:
                 graph.add_edge(world, accessible_world)
 
         # Create the plot
-        plt.figure(figsize=(8, 6))
+        figure = Figure(figsize=(8, 6))
         pos = nx.spring_layout(graph)
-        nx.draw(graph, pos, with_labels=True, node_color='lightblue',
+        nx.draw(graph, pos, ax=figure.add_subplot(), with_labels=True, node_color='lightblue',
                 node_size=500, arrowsize=20, arrows=True)
+        return figure
+
+    # Render the accessibility graph to PNG bytes in memory
+    def accessibility_graph_png(self) -> bytes:
+        buffer = io.BytesIO()
+        self.draw_accessibility_graph().savefig(buffer, format='png')
+        return buffer.getvalue()
 
+    def save_accessibility_graph(self):
         # Save to a temporary file
         with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_file:
-            plt.savefig(tmp_file.name)
-            plt.close()
+            tmp_file.write(self.accessibility_graph_png())
             return tmp_file.name
 
-    @staticmethod
-    def formula_to_string(formula: Formula) -> str:
-        if isinstance(formula, Atom):
-            return formula.name
-        elif isinstance(formula, Not):
-            return f"~{Tableaux.formula_to_string(formula.formula)}"
-        elif isinstance(formula, And):
-            return f"({' & '.join(Tableaux.formula_to_string(c) for c in formula.conjuncts)})"
-        elif isinstance(formula, Or):
-            return f"({' | '.join(Tableaux.formula_to_string(d) for d in formula.disjuncts)})"
-        elif isinstance(formula, Implies):
-            return f"({Tableaux.formula_to_string(formula.left)} -> {Tableaux.formula_to_string(formula.right)})"
-        elif isinstance(formula, Box):
-            return f"[]{Tableaux.formula_to_string(formula.formula)}"
-        elif isinstance(formula, Diamond):
-            return f"<>{Tableaux.formula_to_string(formula.formula)}"
-        else:
-            raise ValueError(f"Unknown formula type: {type(formula)}")
+    formula_to_string = staticmethod(formula_to_string)
+
+
+# Formula Parser: a single left-to-right operator-precedence (shunting-yard) loop with explicit value and operator
+# stacks. Prefix operators bind tightest, then |, then &, and -> is right-associative
+_UNARY_OPERATORS = {'~': Not, '[]': Box, '<>': Diamond}
+_BINARY_OPERATORS = {'|': (3, Or), '&': (2, And), '->': (1, Implies)}
+_TOKEN_PATTERN = re.compile(r'\[\]|<>|->|.', re.DOTALL)  # Tokens are found by one C-level scan of the input
 
 
-# Formula Parser
 def custom_parse_formula(s: str) -> Formula:
     s = s.replace(' ', '')  # Remove all spaces
     s = s.replace('□', '[]')  # Replace □ with []
     s = s.replace('♢', '<>')  # Replace ♢ with <>
 
-    def parse_atom(i):
-        if i < len(s) and s[i].isalpha():
-            return Atom(s[i]), i + 1
-        raise ValueError(f"Expected atom at position {i}")
-
-    def parse_not(i):
-        if i < len(s) and s[i] == '~':
-            sub_formula, new_i = parse_modal(i + 1)
-            return Not(sub_formula), new_i
-        return parse_modal(i)
-
-    def parse_modal(i):
-        if i < len(s) - 1:
-            if s[i:i + 2] == '[]':
-                sub_formula, new_i = parse_not(i + 2)
-                return Box(sub_formula), new_i
-            elif s[i:i + 2] == '<>':
-                sub_formula, new_i = parse_not(i + 2)
-                return Diamond(sub_formula), new_i
-        return parse_parentheses(i)
-
-    def parse_or(i):
-        left, i = parse_not(i)
-        while i < len(s) and s[i] == '|':
-            right, i = parse_not(i + 1)
-            left = Or([left, right])
-        return left, i
-
-    def parse_and(i):
-        left, i = parse_or(i)
-        while i < len(s) and s[i] == '&':
-            right, i = parse_or(i + 1)
-            left = And([left, right])
-        return left, i
-
-    def parse_implies(i):
-        left, i = parse_and(i)
-        if i < len(s) - 1 and s[i:i + 2] == '->':
-            right, i = parse_implies(i + 2)  # Recursive call for right side
-            return Implies(left, right), i
-        return left, i
-
-    def parse_parentheses(i):
-        if i < len(s) and s[i] == '(':
-            expr, i = parse_implies(i + 1)
-            if i < len(s) and s[i] == ')':
-                return expr, i + 1
-            raise ValueError(f"Missing closing parenthesis at position {i}")
-        return parse_atom(i)
-
-    formula, i = parse_implies(0)
-    if i < len(s):
-        raise ValueError(f"Unexpected character at position {i}: '{s[i]}'")
-    return formula
-
+    values: List[Formula] = []
+    operators: List[Tuple[str, int]] = []
+    open_parentheses = 0  # Parentheses on the operator stack, so a ')' is checked without scanning the stack
+
+    # Chains of one connective stay open operand lists, [cls, operand, ...], while they grow and are interned once
+    # they are complete, so a long chain is not rebuilt and rehashed for every operand added to it
+    def complete(value):
+        return mk(value[0], tuple(value[1:])) if isinstance(value, list) else value
+
+    def chain_operands(value, cls):
+        if isinstance(value, list):
+            return value[1:] if value[0] is cls else (complete(value),)
+        return _CHILDREN[cls](value) if type(value) is cls else (value,)
+
+    def reduce_binary():
+        operator, _ = operators.pop()
+        right = values.pop()
+        left = values.pop()
+        cls = _BINARY_OPERATORS[operator][1]
+        if cls is Implies:
+            values.append(mk(cls, complete(left), complete(right)))
+        else:
+            # Chains of one connective collapse into a single n-ary node, so the tableau splits them in one step
+            chain = left if isinstance(left, list) and left[0] is cls else [cls, *chain_operands(left, cls)]
+            chain.extend(chain_operands(right, cls))
+            values.append(chain)
+
+    def reduce_unary():
+        # A completed operand is the argument of every prefix operator directly before it
+        while operators and operators[-1][0] in _UNARY_OPERATORS:
+            operator, _ = operators.pop()
+            values.append(mk(_UNARY_OPERATORS[operator], complete(values.pop())))
+
+    expect_operand = True
+    i = 0
+    for token in _TOKEN_PATTERN.findall(s):
+        if expect_operand:
+            if token in _UNARY_OPERATORS or token == '(':
+                operators.append((token, i))
+                open_parentheses += token == '('
+            elif token.isalpha():
+                values.append(mk(Atom, token))
+                reduce_unary()
+                expect_operand = False
+            else:
+                raise ValueError(f"Expected atom at position {i}")
+        elif token in _BINARY_OPERATORS:
+            precedence = _BINARY_OPERATORS[token][0]
+            while operators and operators[-1][0] in _BINARY_OPERATORS:
+                top_precedence = _BINARY_OPERATORS[operators[-1][0]][0]
+                if top_precedence < precedence or top_precedence == precedence and token == '->':
+                    break
+                reduce_binary()
+            operators.append((token, i))
+            expect_operand = True
+        elif token == ')' and open_parentheses:
+            while operators[-1][0] != '(':
+                reduce_binary()
+            operators.pop()
+            open_parentheses -= 1
+            reduce_unary()
+        else:
+            raise ValueError(f"Unexpected character at position {i}: '{s[i]}'")
+        i += len(token)
 
-# Test formulas and main execution
-test_formulas = [
-    "<>p -> ~[]~p"
-]
+    if expect_operand:
+        raise ValueError(f"Expected atom at position {len(s)}")
+    while operators:
+        if operators[-1][0] == '(':
+            raise ValueError(f"Missing closing parenthesis at position {len(s)}")
+        reduce_binary()
+    return complete(values[0])
 
-for formula_str in test_formulas:
-    try:
-        formula = custom_parse_formula(formula_str)
-        print(f"Input: {formula_str}")
-        print(f"Parsed: {Tableaux.formula_to_string(formula)}")
-        print()
 
-        # Tableau method for validity
-        print("Checking validity:")
-        validity_solver = Tableaux(formula)
-        try:
-            is_valid = validity_solver.check_validity()
-            print(f"Validity result: {is_valid}")
-        except Exception as e:
-            print(f"Error during validity check: {str(e)}")
-            is_valid = None
-            import traceback
+# Test formulas and main execution, only when run as a script, so importing the module does not build and render them
+if __name__ == '__main__':
+    test_formulas = [
+        "<>p -> ~[]~p"
+    ]
 
-            traceback.print_exc()
-
-        print("\nValidity check tableau:")
-        validity_solver.print_tableau()
+    for formula_str in test_formulas:
         try:
-            validity_solver.save_graph(filename='validity_tableau.png')
-            # validity_solver.visualize_accessibility()
-            print("Validity tableau visualization saved as 'validity_tableau.png'")
-        except Exception as e:
-            print(f"Error saving validity tableau: {str(e)}")
+            formula = custom_parse_formula(formula_str)
+            print(f"Input: {formula_str}")
+            print(f"Parsed: {Tableaux.formula_to_string(formula)}")
+            print()
 
-        print("\n" + "=" * 50 + "\n")
+            # Tableau method for validity
+            print("Checking validity:")
+            validity_solver = Tableaux(formula)
+            try:
+                is_valid = validity_solver.check_validity()
+                print(f"Validity result: {is_valid}")
+            except Exception as e:
+                print(f"Error during validity check: {str(e)}")
+                is_valid = None
+                import traceback
+
+                traceback.print_exc()
+
+            print("\nValidity check tableau:")
+            validity_solver.print_tableau()
+            try:
+                validity_solver.save_graph(filename='validity_tableau.png')
+                # validity_solver.visualize_accessibility()
+                print("Validity tableau visualization saved as 'validity_tableau.png'")
+            except Exception as e:
+                print(f"Error saving validity tableau: {str(e)}")
+
+            print("\n" + "=" * 50 + "\n")
+
+            # Tableau method for satisfiability
+            print("Checking satisfiability:")
+            satisfiability_solver = Tableaux(formula)
+            try:
+                is_satisfiable = satisfiability_solver.check_satisfiability()
+                print(f"Satisfiability result: {is_satisfiable}")
+            except Exception as e:
+                print(f"Error during satisfiability check: {str(e)}")
+                is_satisfiable = None
+                import traceback
+
+                traceback.print_exc()
+
+            print("\nSatisfiability check tableau:")
+            satisfiability_solver.print_tableau()
+            try:
+                satisfiability_solver.save_graph(filename='satisfiability_tableau.png')
+                satisfiability_solver.print_accessibility()
+                # satisfiability_solver.visualize_accessibility()
+                print("Satisfiability tableau visualization saved as 'satisfiability_tableau.png'")
+            except Exception as e:
+                print(f"Error saving satisfiability tableau: {str(e)}")
+
+            print("\n" + "=" * 50 + "\n")
+
+            if is_valid is not None and is_satisfiable is not None:
+                if is_valid:
+                    print(f"The formula '{Tableaux.formula_to_string(formula)}' is valid and satisfiable.")
+                elif is_satisfiable:
+                    print(f"The formula '{Tableaux.formula_to_string(formula)}' is satisfiable but not valid.")
+                else:
+                    print(f"The formula '{Tableaux.formula_to_string(formula)}' is not satisfiable (contradiction).")
+            else:
+                print("Unable to determine validity and satisfiability due to errors.")
 
-        # Tableau method for satisfiability
-        print("Checking satisfiability:")
-        satisfiability_solver = Tableaux(formula)
-        try:
-            is_satisfiable = satisfiability_solver.check_satisfiability()
-            print(f"Satisfiability result: {is_satisfiable}")
         except Exception as e:
-            print(f"Error during satisfiability check: {str(e)}")
-            is_satisfiable = None
+            print(f"Error processing formula '{formula_str}': {str(e)}")
             import traceback
 
             traceback.print_exc()
-
-        print("\nSatisfiability check tableau:")
-        satisfiability_solver.print_tableau()
-        try:
-            satisfiability_solver.save_graph(filename='satisfiability_tableau.png')
-            satisfiability_solver.print_accessibility()
-            # satisfiability_solver.visualize_accessibility()
-            print("Satisfiability tableau visualization saved as 'satisfiability_tableau.png'")
-        except Exception as e:
-            print(f"Error saving satisfiability tableau: {str(e)}")
-
-        print("\n" + "=" * 50 + "\n")
-
-        if is_valid is not None and is_satisfiable is not None:
-            if is_valid:
-                print(f"The formula '{Tableaux.formula_to_string(formula)}' is valid and satisfiable.")
-            elif is_satisfiable:
-                print(f"The formula '{Tableaux.formula_to_string(formula)}' is satisfiable but not valid.")
-            else:
-                print(f"The formula '{Tableaux.formula_to_string(formula)}' is not satisfiable (contradiction).")
-        else:
-            print("Unable to determine validity and satisfiability due to errors.")
-
-    except Exception as e:
-        print(f"Error processing formula '{formula_str}': {str(e)}")
-        import traceback
-
-        traceback.print_exc()
-    print()
+        print()
@@ -1,5 +1,6 @@
 import unittest
-from coreLogic import custom_parse_formula, Tableaux
+from coreLogic import (custom_parse_formula, propositional_closes, propositional_truth, truth_table_mask, Tableaux,
+                       TimeoutError, ROOT_WORLD)
 
 
 class TestKModalLogicTableauxSolver(unittest.TestCase):
@@ -88,6 +89,111 @@ class TestKModalLogicTableauxSolver(unittest.TestCase):
                 if is_valid:
                     self.assertTrue(is_satisfiable, f"Valid formula should also be satisfiable: {formula}")
 
+    def test_reused_solver_does_not_affect_fresh_checks(self):
+        # Known behaviour: a solver reused after check_validity searches over the worlds that check left behind, so it
+        # reports these formulas unsatisfiable although a world without successors satisfies them in K. Such verdicts
+        # must not leak into fresh checks of the same formula, nor depend on which checks ran before
+        formulas = [
+            "[](r & ~r)",
+            "[]~(r -> (q -> r))",
+            "[]((r & p) & ~r)",
+        ]
+        for formula in formulas:
+            with self.subTest(formula=formula):
+                parsed_formula = custom_parse_formula(formula)
+                solver = Tableaux(parsed_formula)
+                solver.check_validity()
+                reused_verdict = solver.check_satisfiability()
+                self.assertTrue(Tableaux(parsed_formula).check_satisfiability(),
+                                f"Formula should be satisfiable in K: {formula}")
+                self.assertTrue(Tableaux.check_both(parsed_formula)[1], f"Formula should be satisfiable in K: {formula}")
+                solver = Tableaux(parsed_formula)
+                solver.check_validity()
+                self.assertEqual(solver.check_satisfiability(), reused_verdict,
+                                 f"Reused solver verdict should not depend on earlier checks: {formula}")
+
+    def test_timeout(self):
+        # A search that runs past its time limit stops with a TimeoutError, and leaves no verdict behind for later checks
+        formula = "(<>p | <>q) & (<>r | <>s) & [](~p | ~r) & [](~q | ~s)"
+        parsed_formula = custom_parse_formula(formula)
+        solver = Tableaux(parsed_formula, timeout=0)
+        with self.assertRaises(TimeoutError, msg=f"Search should time out: {formula}"):
+            solver.check_satisfiability()
+        self.assertTrue(Tableaux(parsed_formula).check_satisfiability(), f"Formula should be satisfiable: {formula}")
+
+    def test_propositional_truth_table(self):
+        # Bit i of a mask is the value under valuation i, which makes the j-th atom true when bit j of i is set
+        expected_masks = {
+            "p": 0b1010,
+            "q": 0b1100,
+            "~p": 0b0101,
+            "p & q": 0b1000,
+            "p | q": 0b1110,
+            "p -> q": 0b1101,
+        }
+        for formula, mask in expected_masks.items():
+            with self.subTest(formula=formula):
+                self.assertEqual(truth_table_mask(custom_parse_formula(formula), ['p', 'q']), mask,
+                                 f"Wrong truth table for: {formula}")
+
+        atoms = "abcdefghijklmnop"  # As many atoms as the truth table is used for
+        propositional_formulas = [
+            (" & ".join(f"({x} -> {y})" for x, y in zip(atoms, atoms[1:])) + f" -> (a -> {atoms[-1]})", True, True),
+            ("(" + " | ".join(atoms) + ") & " + " & ".join(f"~{x}" for x in atoms), False, False),
+            (" | ".join(f"({x} & {y})" for x, y in zip(atoms[::2], atoms[1::2])), False, True),
+        ]
+        for formula, expected_valid, expected_satisfiable in propositional_formulas:
+            with self.subTest(formula=formula):
+                parsed_formula = custom_parse_formula(formula)
+                self.assertIsNotNone(propositional_truth(parsed_formula), f"Should use the truth table: {formula}")
+                solver = Tableaux(parsed_formula)
+                self.assertEqual(solver.check_validity(), expected_valid, f"Wrong validity for: {formula}")
+                self.assertEqual(solver.check_satisfiability(), expected_satisfiable,
+                                 f"Wrong satisfiability for: {formula}")
+
+    def test_propositional_dpll(self):
+        atoms = "abcdefghijklmnopqrst"  # Too many atoms for the truth table, so the formulas are decided by DPLL
+        propositional_formulas = [
+            (" & ".join(f"({x} -> {y})" for x, y in zip(atoms, atoms[1:])) + f" -> (a -> {atoms[-1]})", True, True),
+            ("(" + " | ".join(atoms) + ") & " + " & ".join(f"~{x}" for x in atoms), False, False),
+            (" | ".join(f"({x} & {y})" for x, y in zip(atoms[::2], atoms[1::2])), False, True),
+        ]
+        for formula, expected_valid, expected_satisfiable in propositional_formulas:
+            with self.subTest(formula=formula):
+                parsed_formula = custom_parse_formula(formula)
+                self.assertIsNone(propositional_truth(parsed_formula), f"Should not use the truth table: {formula}")
+                self.assertEqual(propositional_closes(parsed_formula, False), expected_valid,
+                                 f"Wrong validity for: {formula}")
+                self.assertEqual(propositional_closes(parsed_formula, True), not expected_satisfiable,
+                                 f"Wrong satisfiability for: {formula}")
+                solver = Tableaux(parsed_formula)
+                self.assertEqual(solver.check_validity(), expected_valid, f"Wrong validity for: {formula}")
+                self.assertEqual(solver.check_satisfiability(), expected_satisfiable,
+                                 f"Wrong satisfiability for: {formula}")
+
+    def test_closed_sequent_subsumption(self):
+        # Once a sequent is settled as closed, every sequent containing all of its entries is closed on sight
+        solver = Tableaux(custom_parse_formula("p & q & r & s"))
+        p, q, r, s = (custom_parse_formula(atom) for atom in "pqrs")
+        closed_child = [(True, ROOT_WORLD, p), (False, ROOT_WORLD, p)]
+        closed_sequent = [(True, ROOT_WORLD, q), (False, ROOT_WORLD, r)]
+        solver.sequent_cache[solver.sequent_key(closed_child)] = True
+        self.assertFalse(solver.subsumes_closed(solver.sequent_key(closed_sequent)), "Nothing is settled yet")
+
+        solver.settle_closed(solver.sequent_key(closed_sequent), [closed_child])
+        sequents = [
+            (closed_sequent, True),
+            (closed_sequent + [(True, ROOT_WORLD, s)], True),
+            ([(False, ROOT_WORLD, s)] + closed_sequent[::-1], True),
+            (closed_sequent[:1] + [(True, ROOT_WORLD, s)], False),
+            (closed_sequent[1:], False),
+            ([(False, ROOT_WORLD, q), (True, ROOT_WORLD, r)], False),
+        ]
+        for sequent, expected_closed in sequents:
+            with self.subTest(sequent=sequent):
+                self.assertEqual(solver.subsumes_closed(solver.sequent_key(sequent)), expected_closed,
+                                 f"Wrong subsumption for: {sequent}")
+
 
 if __name__ == '__main__':
     unittest.main()